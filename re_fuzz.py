@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import random
+import re
+import signal
+import sys
+import time
+
+from re_store import PatternStore
+from re_to_nfa import search
+
+# keep the alphabet small so random texts actually hit the random patterns
+ALPHABET = "abc"
+
+# texts sometimes contain dashes and regex metacharacters too, none of which a
+# pattern can match unless it asks for them
+TEXT_EXTRAS = "-()|*"
+TEXT_EXTRAS_WEIGHT = 0.1
+
+
+# every way of running the engine that should agree with the stdlib
+def search_quiet(text, regex):
+    return search(text, regex)
+
+
+def search_display(text, regex):
+    # display mode prints every step, throw that away
+    with contextlib.redirect_stdout(io.StringIO()):
+        return search(text, regex, display=True)
+
+
+# created under __main__ so its segments get unlinked however the run ends
+shared_store = None
+
+
+def search_shared(text, regex):
+    return shared_store.search(text, regex)
+
+
+engine_modes = {"search": search_quiet,
+                "search_display": search_display,
+                "shared_store": search_shared}
+
+
+# build a random regex out of the syntax the engine supports
+def random_regex(rng, depth=2):
+
+    def random_char_class():
+        roll = rng.random()
+        if roll < 0.45:
+            start, stop = sorted(rng.sample(ALPHABET, 2))
+            return f"[{start}-{stop}]"
+        members = "".join(rng.sample(ALPHABET, rng.randint(1, len(ALPHABET))))
+        # a dash at either end of the class is a literal dash
+        if roll < 0.55:
+            members = rng.choice(("-" + members, members + "-"))
+        return "[" + members + "]"
+
+    def random_atom(depth):
+        roll = rng.random()
+        if depth > 0 and roll < 0.25:
+            branches = [random_sequence(depth - 1) for _ in range(rng.randint(1, 3))]
+            return "(" + "|".join(branches) + ")", depth - 1 > 0
+        elif roll < 0.45:
+            return random_char_class(), False
+        elif roll < 0.55:
+            return ".", False
+        # literal dash outside a class, like a-b
+        elif roll < 0.6:
+            return "-", False
+        return rng.choice(ALPHABET), False
+
+    def random_sequence(depth):
+        units = []
+        for _ in range(rng.randint(1, 3)):
+            atom, has_subgroups = random_atom(depth)
+            roll = rng.random()
+            if roll < 0.15:
+                atom += "*"
+            elif roll < 0.3:
+                atom += "+"
+            elif roll < 0.45:
+                atom += "?"
+            # repetition counters only take single digits and can't wrap nested groups
+            elif roll < 0.55 and not has_subgroups:
+                min_reps = rng.randint(1, 3)
+                atom += f"{{{min_reps},{rng.randint(min_reps, 4)}}}"
+            units.append(atom)
+        return "".join(units)
+
+    return random_sequence(depth)
+
+
+def random_text(rng, max_length=8):
+    def random_letter():
+        if rng.random() < TEXT_EXTRAS_WEIGHT:
+            return rng.choice(TEXT_EXTRAS)
+        return rng.choice(ALPHABET)
+
+    return "".join(random_letter() for _ in range(rng.randint(0, max_length)))
+
+
+# the engine stops at the first accepting state, so the span it reports is
+# the shortest prefix of the text that the regex accepts
+def shortest_prefix_span(accepts, text):
+    for stop in range(len(text) + 1):
+        if accepts(text[:stop]):
+            return 0, stop
+    return None
+
+
+def reference_span(text, regex):
+    return shortest_prefix_span(lambda prefix: re.fullmatch(regex, prefix) is not None, text)
+
+
+def engine_span(mode, text, regex):
+    return shortest_prefix_span(lambda prefix: mode(prefix, regex), text)
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+def raise_time_limit(signum, frame):
+    raise TimeLimitExceeded
+
+
+# returns the result and how long the call took, or None if it blew past the time
+# limit. exponential blowups would otherwise hang the harness, so calls get cut
+# off with an alarm where the platform supports it
+def call_with_time_limit(func, *args, time_limit=1.0):
+    has_alarm = hasattr(signal, "SIGALRM")
+    if has_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, raise_time_limit)
+        signal.setitimer(signal.ITIMER_REAL, time_limit)
+
+    try:
+        start = time.perf_counter()
+        out = func(*args)
+        elapsed = time.perf_counter() - start
+    except TimeLimitExceeded:
+        return None
+    finally:
+        if has_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    if elapsed > time_limit:
+        return None
+    return out, elapsed
+
+
+# returns the best of a few runs, or None if a single run blew past the time limit
+def time_call(func, *args, repeats=3, time_limit=1.0):
+    best = float("inf")
+    for _ in range(repeats):
+        outcome = call_with_time_limit(func, *args, time_limit=time_limit)
+        if outcome is None:
+            return None
+        best = min(best, outcome[1])
+    return best
+
+
+# compare every engine mode against re on random regexes and texts. a mode that
+# runs past the time limit on a short text is reported as a failure
+def run_differential(rng, num_regexes=200, texts_per_regex=10, time_limit=1.0):
+    failures = []
+    timings = []
+    for _ in range(num_regexes):
+        regex = random_regex(rng)
+        # compile up front so shared_store is timed on matching like the other modes
+        shared_store.get(regex)
+        for _ in range(texts_per_regex):
+            text = random_text(rng)
+            expected = re.match(regex, text) is not None
+            expected_span = reference_span(text, regex)
+            for name, mode in engine_modes.items():
+                outcome = call_with_time_limit(mode, text, regex, time_limit=time_limit)
+                span_outcome = outcome and call_with_time_limit(engine_span, mode, text, regex,
+                                                                time_limit=time_limit)
+                if not span_outcome:
+                    failures.append((name, text, regex, "timed out", (expected, expected_span)))
+                    continue
+
+                out, elapsed = outcome
+                span, _ = span_outcome
+                timings.append((name, text, regex, elapsed))
+                if out != expected or span != expected_span:
+                    failures.append((name, text, regex, (out, span), (expected, expected_span)))
+
+    return failures, timings
+
+
+# the engine returns as soon as it accepts, so a regex that accepts early never
+# scans the rest of the text and its timings say nothing about scaling. keep
+# drawing until search() rejects the shortest text, which means no prefix of it
+# was accepted either. a search that runs out of time is a blowup in its own
+# right, so that case is kept for run_scaling to flag
+def random_scanning_case(rng, length, time_limit=1.0):
+    while True:
+        regex = random_regex(rng)
+        unit = random_text(rng, max_length=4) or rng.choice(ALPHABET)
+        text = (unit * length)[:length]
+        outcome = call_with_time_limit(search_quiet, text, regex, time_limit=time_limit)
+        if outcome is None or not outcome[0]:
+            return regex, unit
+
+
+# time each regex against longer and longer texts. the engine should take
+# O(n*m) time, so the cost per n*m should stay flat as the text doubles. a
+# regex whose cost per n*m grows by more than the slack on every doubling is
+# flagged as a regression. a single noisy timing only bumps one step
+def run_scaling(rng, num_regexes=30, lengths=(64, 128, 256, 512), slack=1.4, time_limit=1.0):
+    regressions = []
+    for _ in range(num_regexes):
+        regex, unit = random_scanning_case(rng, lengths[0], time_limit)
+        for name, mode in engine_modes.items():
+            costs = []
+            for length in lengths:
+                text = (unit * length)[:length]
+                elapsed = time_call(mode, text, regex, time_limit=time_limit)
+                # ran out of time, that's a blowup no matter how the earlier lengths went
+                if elapsed is None:
+                    costs.append((length, float("inf")))
+                    break
+                costs.append((length, elapsed / (length * len(regex))))
+
+            first_cost, last_cost = costs[0][1], costs[-1][1]
+            if last_cost == float("inf"):
+                regressions.append((name, regex, unit, costs, float("inf")))
+                continue
+
+            steps = [cost / previous_cost if previous_cost > 0 else 0.0
+                     for (_, previous_cost), (_, cost) in zip(costs, costs[1:])]
+            if all(step > slack for step in steps):
+                regressions.append((name, regex, unit, costs, last_cost / first_cost))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Differential fuzzing of re_to_nfa against re")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--regexes", type=int, default=200)
+    parser.add_argument("--texts", type=int, default=10)
+    parser.add_argument("--scaling-regexes", type=int, default=30)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    shared_store = PatternStore()
+    try:
+        failures, timings = run_differential(rng, args.regexes, args.texts)
+        for name, text, regex, out, expected in failures:
+            print(f"Mismatch ({name}): {text!r}, {regex!r}, got {out}, expected {expected}")
+
+        slowest = sorted(timings, key=lambda timing: timing[-1], reverse=True)[:5]
+        print(f"Ran {len(timings)} cases, slowest:")
+        for name, text, regex, elapsed in slowest:
+            print(f"    {elapsed * 1000:8.3f} ms  ({name}) {text!r}, {regex!r}")
+
+        regressions = run_scaling(rng, args.scaling_regexes)
+        for name, regex, unit, costs, growth in regressions:
+            lengths = ", ".join(f"n={length}: {cost * 1e9:.1f} ns" for length, cost in costs)
+            print(f"Super-linear ({name}): {regex!r} on {unit!r} repeated, "
+                  f"cost per n*m grew {growth:.1f}x ({lengths})")
+    finally:
+        shared_store.unlink()
+
+    print(f"{len(failures)} mismatches, {len(regressions)} scaling regressions")
+    sys.exit(1 if failures or regressions else 0)
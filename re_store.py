@@ -0,0 +1,550 @@
+import hashlib
+import mmap
+import os
+import queue
+import struct
+import sys
+import time
+import types
+from array import array
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import _posixshmem
+except ImportError:
+    # windows segments go away with their last handle and never touch the resource tracker
+    _posixshmem = None
+
+from re_to_nfa import char_group_matches, get_epsilon_transitions, get_match_transitions, text_range, tokenize
+
+# segment layout, in native byte order since segments never leave the machine:
+#   header: magic, version, number of tokens, number of epsilon edges, token text length, regex length
+#   C int tables: match transitions, epsilon offsets, epsilon targets, token offsets
+#   byte tables: state flags, 256-bit class bitmap per state, utf-8 token text, utf-8 regex
+# the int tables are written with array("i") so they read back with memoryview.cast("i")
+HEADER = struct.Struct("=4sIIIII")
+MAGIC = b"RNFA"
+VERSION = 1
+INT_SIZE = array("i").itemsize
+BITMAP_SIZE = 32
+
+# state matches every letter, so no need to look at the bitmap or the token text
+MATCHES_ANY = 1
+
+# how long to wait on a segment another process is still filling in
+ATTACH_TIMEOUT = 1.0
+
+# how many times to replace a stale segment before giving up
+ATTACH_ATTEMPTS = 3
+
+
+class StaleSegment(Exception):
+    """A segment that was never finished, or doesn't hold the pattern it's named after."""
+
+    def __init__(self, message, inode=None):
+        super().__init__(message)
+        self.inode = inode
+
+
+def pattern_name(regex):
+    digest = hashlib.blake2b(COMPILER_FINGERPRINT + regex.encode("utf-8"), digest_size=10).hexdigest()
+    # kept short, some platforms cap shared memory names at 31 characters
+    return f"rnfa{VERSION}_{digest}"
+
+
+def _table_sizes(num_states, num_edges, blob_length, regex_length):
+    int_counts = (num_states, num_states + 1, num_edges, num_states + 1)
+    byte_counts = (num_states, num_states * BITMAP_SIZE, blob_length, regex_length)
+    return int_counts, byte_counts
+
+
+# flatten a compiled nfa into the bytes stored in shared memory. the bitmaps
+# cover latin-1, anything past that falls back on the token text
+def pack_pattern(regex):
+    # same wrapping search() does
+    tokens = tokenize("(" + regex + ")")
+    match_transitions = get_match_transitions(tokens)
+    epsilon_transitions = get_epsilon_transitions(tokens)
+
+    # one state per token plus the accepting state
+    num_states = len(tokens) + 1
+
+    match_next = [-1] * num_states
+    for state, next_states in match_transitions.items():
+        if next_states:
+            match_next[state] = next_states[0]
+
+    epsilon_offsets = [0]
+    epsilon_targets = []
+    for state in range(num_states):
+        epsilon_targets.extend(epsilon_transitions.get(state, []))
+        epsilon_offsets.append(len(epsilon_targets))
+
+    flags = bytearray(num_states)
+    bitmaps = bytearray(num_states * BITMAP_SIZE)
+    token_blob = bytearray()
+    token_offsets = [0]
+    for state, char_group in enumerate(tokens):
+        if "." in char_group:
+            flags[state] |= MATCHES_ANY
+        for code in range(256):
+            if char_group_matches(chr(code), char_group):
+                bitmaps[state * BITMAP_SIZE + (code >> 3)] |= 1 << (code & 7)
+        token_blob.extend(char_group.encode("utf-8"))
+        token_offsets.append(len(token_blob))
+    # accepting state has no text
+    token_offsets.append(len(token_blob))
+
+    regex_text = regex.encode("utf-8")
+
+    int_tables = (match_next, epsilon_offsets, epsilon_targets, token_offsets)
+    body = b"".join(array("i", table).tobytes() for table in int_tables)
+    body += bytes(flags) + bytes(bitmaps) + bytes(token_blob) + regex_text
+
+    return num_states, len(epsilon_targets), len(token_blob), len(regex_text), body
+
+
+# bytecode, names and constants of a function, leaving out the file path and line
+# numbers so the same code imported from anywhere gives the same bytes
+def _code_fingerprint(code):
+    parts = [code.co_code, "\0".join(code.co_names).encode("utf-8")]
+    parts.extend(_const_fingerprint(const) for const in code.co_consts)
+    return b"\0".join(parts)
+
+
+def _const_fingerprint(const):
+    if isinstance(const, types.CodeType):
+        return _code_fingerprint(const)
+    elif isinstance(const, tuple):
+        return b"(" + b",".join(_const_fingerprint(item) for item in const) + b")"
+    elif isinstance(const, frozenset):
+        # set order depends on the per-process hash seed
+        return b"{" + b",".join(sorted(_const_fingerprint(item) for item in const)) + b"}"
+    return repr(const).encode("utf-8")
+
+
+# segments compiled by a different build of the compiler can't be trusted, so
+# the code that builds the tables goes into every segment name
+COMPILER_FINGERPRINT = hashlib.blake2b(
+    b"".join(_code_fingerprint(func.__code__) for func in (tokenize, get_match_transitions, get_epsilon_transitions,
+                                                           text_range, char_group_matches, pack_pattern)),
+    digest_size=8).digest()
+
+
+class SharedPattern:
+    """A compiled NFA read straight out of a shared memory segment."""
+
+    def __init__(self, segment, regex):
+        self.segment = segment
+        buffer = segment.buf
+
+        _, version, num_states, num_edges, blob_length, regex_length = HEADER.unpack_from(buffer)
+        if version != VERSION:
+            raise StaleSegment(f"shared pattern {segment.name} has version {version}, expected {VERSION}")
+        self.num_states = num_states
+
+        int_counts, byte_counts = _table_sizes(num_states, num_edges, blob_length, regex_length)
+
+        # some platforms round segments up to a whole page
+        size = HEADER.size + sum(int_counts) * INT_SIZE + sum(byte_counts)
+        if not size <= segment.size < size + mmap.PAGESIZE:
+            raise StaleSegment(f"shared pattern {segment.name} is {segment.size} bytes, expected {size}")
+        if bytes(buffer[size - regex_length:size]) != regex.encode("utf-8"):
+            raise StaleSegment(f"shared pattern {segment.name} holds a different regex")
+
+        tables = []
+        offset = HEADER.size
+        for count in int_counts:
+            tables.append(buffer[offset:offset + count * INT_SIZE].cast("i"))
+            offset += count * INT_SIZE
+        for count in byte_counts:
+            tables.append(buffer[offset:offset + count])
+            offset += count
+
+        self.match_next, \
+            self.epsilon_offsets, \
+            self.epsilon_targets, \
+            self.token_offsets, \
+            self.flags, \
+            self.bitmaps, \
+            self.token_blob, \
+            self.regex_text = tables
+
+    def _token(self, state):
+        return bytes(self.token_blob[self.token_offsets[state]:self.token_offsets[state + 1]]).decode("utf-8")
+
+    # find all states possible through epsilon transitions
+    def _epsilon_closure(self, nodes):
+        reachable_states = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node in reachable_states:
+                continue
+            reachable_states.add(node)
+            if node < self.num_states:
+                stack.extend(self.epsilon_targets[self.epsilon_offsets[node]:self.epsilon_offsets[node + 1]])
+        return reachable_states
+
+    def _matches(self, state, letter):
+        code = ord(letter)
+        if code < 256:
+            return self.bitmaps[state * BITMAP_SIZE + (code >> 3)] >> (code & 7) & 1
+        if self.flags[state] & MATCHES_ANY:
+            return True
+        return char_group_matches(letter, self._token(state))
+
+    def search(self, text):
+        accepting_state = self.num_states - 1
+
+        # get epsilon states before scanning first character
+        epsilon_states = self._epsilon_closure([0])
+
+        for letter in text:
+            # check if nfa has reached an accepting state
+            if accepting_state in epsilon_states:
+                return True
+
+            # take match transition from every state that matches the letter
+            next_states = []
+            for state in epsilon_states:
+                if state < accepting_state and self.match_next[state] >= 0 and self._matches(state, letter):
+                    next_states.append(self.match_next[state])
+
+            epsilon_states = self._epsilon_closure(next_states)
+
+        return accepting_state in epsilon_states
+
+    def close(self):
+        # views into the segment have to be released before it can be closed
+        for table in (self.match_next, self.epsilon_offsets, self.epsilon_targets, self.token_offsets,
+                      self.flags, self.bitmaps, self.token_blob, self.regex_text):
+            table.release()
+        self.segment.close()
+
+
+class AttachedSegment:
+    """An existing POSIX segment, mapped read-only.
+
+    SharedMemory registers every segment it opens with the resource tracker,
+    which unlinks it when the process exits, so an attaching worker would take
+    the parent's segments down with it. Before python 3.13 there's no way to opt
+    out, so attaching opens the segment directly instead.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        fd = _posixshmem.shm_open("/" + name, os.O_RDONLY, mode=0o600)
+        try:
+            stats = os.fstat(fd)
+            self.size = stats.st_size
+            # tells this segment apart from one that later replaces it under the same name
+            self.inode = stats.st_ino
+            # the creator hasn't set the size yet, and an empty file can't be mapped
+            self._mmap = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ) if self.size else None
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap if self._mmap is not None else b"")
+
+    def close(self):
+        self.buf.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def unlink(self):
+        _posixshmem.shm_unlink("/" + self.name)
+
+
+def _attach_segment(name):
+    if _posixshmem is None:
+        return shared_memory.SharedMemory(name=name)
+    return AttachedSegment(name)
+
+
+# attach to a segment once its creator has finished writing it. a segment stays
+# empty until the creator sets its size, and the creator writes the magic last,
+# so until both are in place keep reopening it. raises StaleSegment if that
+# doesn't happen in time, which means the creator died partway
+def _attach_finished_segment(name):
+    deadline = time.monotonic() + ATTACH_TIMEOUT
+    inode = None
+    while True:
+        try:
+            segment = _attach_segment(name)
+        except ValueError:
+            # SharedMemory can't map an empty segment
+            pass
+        else:
+            if segment.size >= HEADER.size and bytes(segment.buf[:len(MAGIC)]) == MAGIC:
+                return segment
+            # a new segment under this name means another creator is at work, give it the full wait
+            segment_inode = getattr(segment, "inode", None)
+            if segment_inode != inode:
+                inode = segment_inode
+                deadline = time.monotonic() + ATTACH_TIMEOUT
+            segment.close()
+
+        if time.monotonic() > deadline:
+            raise StaleSegment(f"shared pattern {name} was never finished", inode)
+        time.sleep(0.001)
+
+
+# remove a stale segment. given the inode it was seen with, leave it alone if the
+# name now belongs to a replacement some other process already made
+def _unlink_segment(name, inode=None):
+    if _posixshmem is None:
+        return
+    try:
+        if inode is not None:
+            fd = _posixshmem.shm_open("/" + name, os.O_RDONLY, mode=0o600)
+            try:
+                if os.fstat(fd).st_ino != inode:
+                    return
+            finally:
+                os.close(fd)
+        _posixshmem.shm_unlink("/" + name)
+    except FileNotFoundError:
+        # another process already removed it
+        pass
+
+
+class PatternStore:
+    """Compiled patterns kept in shared memory so worker processes can share them.
+
+    Segments are named by a hash of the regex and the compiler code. The first
+    process to ask for a pattern compiles it into a new segment, and every other
+    process attaches to that segment without compiling anything. A segment that
+    was never finished or doesn't hold the regex is replaced. Compile patterns
+    in the parent before forking workers: the process that created a segment
+    owns it, and should call unlink() once no worker needs it anymore.
+    """
+
+    def __init__(self):
+        self.patterns = {}
+        self.created = set()
+
+    def get(self, regex):
+        if regex in self.patterns:
+            return self.patterns[regex]
+
+        name = pattern_name(regex)
+        for _ in range(ATTACH_ATTEMPTS):
+            try:
+                segment = _attach_finished_segment(name)
+            except FileNotFoundError:
+                segment = self._create_segment(name, regex)
+                # another process beat us to it, attach to theirs
+                if segment is None:
+                    continue
+            except StaleSegment as error:
+                # left behind by a creator that died partway. replace it
+                _unlink_segment(name, error.inode)
+                continue
+
+            try:
+                pattern = SharedPattern(segment, regex)
+            except StaleSegment:
+                # holds some other regex or layout. replace it
+                segment.close()
+                if regex in self.created:
+                    self.created.discard(regex)
+                    segment.unlink()
+                else:
+                    _unlink_segment(name, getattr(segment, "inode", None))
+                continue
+
+            self.patterns[regex] = pattern
+            return pattern
+
+        raise RuntimeError(f"couldn't attach to or create shared pattern {name} for {regex!r}")
+
+    def _create_segment(self, name, regex):
+        num_states, num_edges, blob_length, regex_length, body = pack_pattern(regex)
+        try:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=HEADER.size + len(body))
+        except FileExistsError:
+            return None
+
+        segment.buf[HEADER.size:HEADER.size + len(body)] = body
+        HEADER.pack_into(segment.buf, 0, b"\0" * len(MAGIC), VERSION, num_states, num_edges, blob_length,
+                         regex_length)
+        segment.buf[:len(MAGIC)] = MAGIC
+        self.created.add(regex)
+        return segment
+
+    def search(self, text, regex):
+        return self.get(regex).search(text)
+
+    def close(self):
+        for pattern in self.patterns.values():
+            pattern.close()
+        self.patterns.clear()
+
+    def unlink(self):
+        # only remove the segments this process created, after detaching from everything
+        segments = [self.patterns[regex].segment for regex in self.created if regex in self.patterns]
+        self.close()
+        for segment in segments:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                # another process replaced it as stale, only the tracker entry is left to drop
+                resource_tracker.unregister(segment._name, "shared_memory")
+        self.created.clear()
+
+
+# how long the checks below wait on a worker before calling it stuck
+WORKER_TIMEOUT = 30
+
+
+# runs in every worker: attach to the parent's patterns, counting any compiles along the way
+def check_worker(test_cases, results):
+    global pack_pattern
+    compiles = []
+    compile_pattern = pack_pattern
+
+    def counting_pack_pattern(regex):
+        compiles.append(regex)
+        return compile_pattern(regex)
+
+    pack_pattern = counting_pack_pattern
+
+    store = PatternStore()
+    results.put(([store.search(text, regex) for text, regex in test_cases], compiles, sorted(store.created)))
+    store.close()
+
+
+# runs in every worker on a cold start: all workers ask for the same patterns at
+# once, and whoever creates a segment unlinks it once everyone has attached
+def check_cold_worker(test_cases, barrier, results):
+    store = PatternStore()
+    barrier.wait(WORKER_TIMEOUT)
+    results.put(([store.search(text, regex) for text, regex in test_cases], sorted(store.created)))
+    barrier.wait(WORKER_TIMEOUT)
+    store.unlink()
+
+
+# wait for every worker to report back. a worker that crashed never does, so give
+# up after a while rather than hang
+def collect_results(workers, results):
+    outputs = []
+    for _ in workers:
+        try:
+            outputs.append(results.get(timeout=WORKER_TIMEOUT))
+        except queue.Empty:
+            break
+    for worker in workers:
+        worker.join(WORKER_TIMEOUT)
+        if worker.is_alive():
+            worker.terminate()
+    return outputs
+
+
+# leave the kind of segment a creator that died partway leaves behind, without
+# handing it to the resource tracker
+def plant_unfinished_segment(regex, size):
+    _unlink_segment(pattern_name(regex))
+    fd = _posixshmem.shm_open("/" + pattern_name(regex), os.O_CREAT | os.O_EXCL | os.O_RDWR, mode=0o600)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def segment_exists(regex):
+    try:
+        _attach_segment(pattern_name(regex)).close()
+    except (FileNotFoundError, ValueError):
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    from re_to_nfa import search
+
+    test_cases = [("GreenSnake", "(Green)*Snake"),
+                  ("Snake", "(Green)*Snake"),
+                  ("Happppppy Days", "Hap{2,4}y Days"),
+                  ("Ant8", "[A-Z]nt[0-9]"),
+                  ("ant8", "[A-Z]nt[0-9]"),
+                  ("é", "[à-ê]")]
+    expected = [search(text, regex) for text, regex in test_cases]
+
+    # nothing is compiled up front for these. one is left empty, as if its creator
+    # died before setting the size, and one is left without its magic
+    cold_test_cases = [("NoNoNo", "(No)+"),
+                       ("N", "(No)+"),
+                       ("wormwoodwormwoooood", "(wormwo+d){2,4}"),
+                       ("Smith", "(Doctor)?Smith"),
+                       ("DoctorDoctorSmith", "(Doctor)?Smith"),
+                       ("mython", "(P|p|c)ython")]
+    cold_expected = [search(text, regex) for text, regex in cold_test_cases]
+    empty_regex, unfinished_regex = "(No)+", "(Doctor)?Smith"
+
+    # compile everything in the parent, the workers should only attach
+    store = PatternStore()
+    for _, regex in test_cases:
+        store.get(regex)
+
+    failed = False
+    try:
+        for method in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context(method)
+            results = context.Queue()
+            workers = [context.Process(target=check_worker, args=(test_cases, results)) for _ in range(3)]
+            [worker.start() for worker in workers]
+            outputs = collect_results(workers, results)
+            if len(outputs) < len(workers):
+                print(f"Workers failed ({method}): only {len(outputs)} of {len(workers)} reported back")
+                failed = True
+
+            for matches, compiles, created in outputs:
+                if matches != expected or compiles or created:
+                    print(f"Worker failed ({method}): matches {matches}, expected {expected}, "
+                          f"compiled {compiles}, created {created}")
+                    failed = True
+            print(f"{method}: checked {len(workers)} workers attaching")
+
+            if _posixshmem is not None:
+                plant_unfinished_segment(empty_regex, 0)
+                plant_unfinished_segment(unfinished_regex, mmap.PAGESIZE)
+
+            barrier = context.Barrier(4)
+            workers = [context.Process(target=check_cold_worker, args=(cold_test_cases, barrier, results))
+                       for _ in range(4)]
+            [worker.start() for worker in workers]
+            outputs = collect_results(workers, results)
+            if len(outputs) < len(workers):
+                print(f"Cold workers failed ({method}): only {len(outputs)} of {len(workers)} reported back")
+                failed = True
+
+            creators = {regex: 0 for _, regex in cold_test_cases}
+            for matches, created in outputs:
+                if matches != cold_expected:
+                    print(f"Cold worker failed ({method}): matches {matches}, expected {cold_expected}")
+                    failed = True
+                for regex in created:
+                    creators[regex] += 1
+            for regex, count in creators.items():
+                # one worker creates each segment, or replaces the stale one, and the rest attach
+                if count != 1:
+                    print(f"Cold start failed ({method}): {regex!r} created by {count} workers")
+                    failed = True
+                if segment_exists(regex):
+                    print(f"Cold start failed ({method}): segment for {regex!r} outlived its creator's unlink()")
+                    failed = True
+            print(f"{method}: checked {len(workers)} workers starting cold")
+    finally:
+        store.unlink()
+        for _, regex in cold_test_cases:
+            _unlink_segment(pattern_name(regex))
+
+    for _, regex in test_cases:
+        if segment_exists(regex):
+            print(f"Segment for {regex!r} is still there after unlink()")
+            failed = True
+
+    print("Failed" if failed else "All workers attached or replaced stale segments correctly")
+    sys.exit(1 if failed else 0)
@@ -1,5 +1,7 @@
 from collections import defaultdict, deque
 
+metacharacters = "( ) [ ] { } | ? * +".split()
+
 
 def text_range(start, stop):
     return "".join([chr(num) for num in range(ord(start), ord(stop) + 1)])
@@ -142,6 +144,20 @@ def digraph_dfs(graph, node):
     return reachable_states
 
 
+# check if a letter of the input text matches the text of a state
+def char_group_matches(letter, char_group):
+    if letter in char_group or "." in char_group:
+        return True
+    elif "-" in char_group:
+        ranges = ""
+        for i, char in enumerate(char_group):
+            # a dash at either end is just a dash
+            if char == "-" and 0 < i < len(char_group) - 1:
+                ranges += text_range(char_group[i - 1], char_group[i + 1])
+        return letter in ranges
+    return False
+
+
 def recognize(text, regex, match_transitions, epsilon_transitions, display=False):
     # get epsilon states before scanning first character
     epsilon_states = digraph_dfs(epsilon_transitions, 0)
@@ -159,15 +175,8 @@ def recognize(text, regex, match_transitions, epsilon_transitions, display=False
         # get epsilon transition states that match letter of input text
         matched_states = []
         for state, char_group in zip(epsilon_states, epsilon_chars):
-            if letter in char_group or "." in char_group:
+            if char_group_matches(letter, char_group):
                 matched_states.append(state)
-            elif "-" in char_group:
-                ranges = ""
-                for i, char in enumerate(char_group):
-                    if char == "-":
-                        ranges += text_range(char_group[i - 1], char_group[i + 1])
-                if letter in ranges:
-                    matched_states.append(state)
 
         # take match transition from matched state to next state
         next_states = []
@@ -256,6 +265,5 @@ def run_test_cases():
 
 
 if __name__ == "__main__":
-    metacharacters = "( ) [ ] { } | ? * +".split()
     run_test_cases()
     #print(search("AAA", "F{2, 4}", display=False))